@@ -4,13 +4,34 @@ nAble API MCP Server
 
 This MCP (Model Context Protocol) server exposes the nAble API as tools
 that Claude can use directly.
+
+Configuration comes from the environment (or a local .env file when
+python-dotenv is installed):
+
+    NABLE_ENV                 staging | production (default: production)
+    NABLE_<ENV>_USERNAME      API username, e.g. NABLE_PRODUCTION_USERNAME
+    NABLE_<ENV>_PASSWORD      API password
+    NABLE_<ENV>_URL           optional base URL override
+
+Per-tool latency (plus upstream, token and serialization time) is kept in
+memory and reported by the nable_perf_stats tool. For a CPU/memory profile,
+run the server under Scalene instead:
+
+    python -m scalene --cli --outfile nable-profile.txt index.py
 """
 
 import os
 import sys
-import json
 import time
-import requests
+import asyncio
+import contextlib
+import functools
+import random
+import string
+from collections import deque
+from dataclasses import dataclass, field
+import httpx
+import orjson
 from datetime import datetime
 from typing import Any
 
@@ -24,429 +45,883 @@ except ImportError:
     MCP_AVAILABLE = False
     print("MCP library not installed. Run: pip install mcp", file=sys.stderr)
 
+# Check for dotenv, used to pick up credentials from a local .env file in dev
+try:
+    from dotenv import load_dotenv
+    DOTENV_AVAILABLE = True
+except ImportError:
+    DOTENV_AVAILABLE = False
+
+# Check for HTTP/2 support (httpx needs h2 for http2=True)
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+    print("h2 not installed, falling back to HTTP/1.1. Run: pip install 'httpx[http2]'", file=sys.stderr)
+
 
 # =============================================================================
 # Configuration
 # =============================================================================
 
+# Default API hosts; override with NABLE_<ENV>_URL. Credentials are never
+# stored here and are read from NABLE_<ENV>_USERNAME / NABLE_<ENV>_PASSWORD.
 ENVIRONMENTS = {
-    "staging": {
-        "base_url": "https://testreproductiveamerica.api-staging.nableivf.com/api/v1",
-        "username": "testreproductiveamerica.clinic.stage",
-        "password": "eL5FPESJm4c1glVE76LVpG9bOE7nwi03"
-    },
-    "production": {
-        "base_url": "https://reproductiveamerica.api.nableivf.com/api/v1",
-        "username": "reproductiveamerica.clinic.prod",
-        "password": "SKPNQslrBJEc3hndBs0hOdWwa8D6zLgD"
-    }
+    "staging": "https://testreproductiveamerica.api-staging.nableivf.com/api/v1",
+    "production": "https://reproductiveamerica.api.nableivf.com/api/v1"
 }
 
 
+@dataclass(frozen=True, slots=True)
+class EnvConfig:
+    base_url: str
+    username: str
+    password: str = field(repr=False)
+
+
+def _load_config(env: str) -> EnvConfig:
+    """Resolve the base URL and credentials for an environment from os.environ"""
+    if DOTENV_AVAILABLE:
+        load_dotenv()
+
+    prefix = f"NABLE_{env.upper()}"
+    username = os.environ.get(f"{prefix}_USERNAME")
+    password = os.environ.get(f"{prefix}_PASSWORD")
+    if not username or not password:
+        raise Exception(f"Missing nAble credentials: set {prefix}_USERNAME and {prefix}_PASSWORD")
+
+    return EnvConfig(
+        base_url=os.environ.get(f"{prefix}_URL") or ENVIRONMENTS[env],
+        username=username,
+        password=password
+    )
+
+
+# =============================================================================
+# Profiling
+# =============================================================================
+
+# Most recent samples (nanoseconds) per timed section
+PERF_SAMPLES = 1024
+_PERF: dict[str, deque] = {}
+
+
+@contextlib.contextmanager
+def _timed(name: str):
+    """Record the wall time of the enclosed block under `name`"""
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        samples = _PERF.get(name)
+        if samples is None:
+            samples = _PERF[name] = deque(maxlen=PERF_SAMPLES)
+        samples.append(time.perf_counter_ns() - start)
+
+
+def _percentile_ms(ordered: list[int], q: float) -> float:
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] / 1e6, 3)
+
+
+def perf_stats() -> dict:
+    """Summarize recorded timings as count and p50/p95/p99 in milliseconds"""
+    stats = {}
+    for name, samples in sorted(_PERF.items()):
+        ordered = sorted(samples)
+        stats[name] = {
+            "count": len(ordered),
+            "p50_ms": _percentile_ms(ordered, 0.50),
+            "p95_ms": _percentile_ms(ordered, 0.95),
+            "p99_ms": _percentile_ms(ordered, 0.99)
+        }
+    return stats
+
+
 # =============================================================================
 # API Client
 # =============================================================================
 
+# Tokens are shared by every client for the same (env, username) so that
+# extra instances don't each authenticate, and refreshes are serialized
+_TOKEN_CACHE: dict[tuple[str, str], dict] = {}
+_TOKEN_LOCKS: dict[tuple[str, str], asyncio.Lock] = {}
+
+# Background refresh fires this many seconds before expiry, ahead of the
+# 60s inline guard, so user calls don't pay for the token POST
+TOKEN_REFRESH_LEAD = 120
+TOKEN_REFRESH_MIN_INTERVAL = 30
+
+# GETs are idempotent, so transient upstream failures are retried with
+# jittered exponential backoff instead of surfacing to the caller
+RETRY_ATTEMPTS = 3
+RETRY_STATUSES = {502, 503, 504}
+RETRY_INITIAL_DELAY = 0.1
+RETRY_MAX_DELAY = 2.0
+
+
 class NableClient:
     """nAble API Client with automatic token management"""
 
-    def __init__(self, env: str = "staging"):
-        config = ENVIRONMENTS.get(env, ENVIRONMENTS["staging"])
-        self.base_url = config["base_url"]
-        self.username = config["username"]
-        self.password = config["password"]
-        self.token = None
-        self.token_expires = 0
-
-    def _ensure_token(self):
-        """Get or refresh the auth token"""
-        if self.token and time.time() < self.token_expires - 60:
-            return
+    __slots__ = ("env", "base_url", "username", "password", "client", "_token_key", "_token_lock", "_auth_token", "_refresher")
 
-        resp = requests.post(
-            f"{self.base_url}/tokens",
-            data={"username": self.username, "password": self.password}
+    def __init__(self, env: str = "staging"):
+        self.env = env if env in ENVIRONMENTS else "staging"
+        config = _load_config(self.env)
+        self.base_url = config.base_url
+        self.username = config.username
+        self.password = config.password
+        self._token_key = (self.env, self.username)
+        if self._token_key not in _TOKEN_LOCKS:
+            _TOKEN_LOCKS[self._token_key] = asyncio.Lock()
+        self._token_lock = _TOKEN_LOCKS[self._token_key]
+        self._auth_token = None
+        self._refresher = None
+
+        # One pooled async client per instance so keep-alive reuses the TLS connection.
+        # With HTTP/2, gathered requests multiplex over that single connection
+        # (responses report resp.http_version == "HTTP/2" once ALPN negotiates h2).
+        # Pool settings live on the transport, since httpx ignores client-level
+        # limits/http2 when a transport is passed.
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Accept": "application/json"},
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            transport=httpx.AsyncHTTPTransport(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+                retries=3
+            )
         )
+
+    @property
+    def token(self) -> str | None:
+        return _TOKEN_CACHE.get(self._token_key, {}).get("token")
+
+    @property
+    def token_expires(self) -> int:
+        return _TOKEN_CACHE.get(self._token_key, {}).get("expires", 0)
+
+    def _token_valid(self) -> bool:
+        return bool(self.token) and time.time() < self.token_expires - 60
+
+    async def _ensure_token(self):
+        """Get or refresh the auth token"""
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._token_refresher())
+
+        if not self._token_valid():
+            # Concurrent tool calls wait on a single refresh instead of each posting
+            async with self._token_lock:
+                if not self._token_valid():
+                    await self._fetch_token()
+
+        # Another instance may have refreshed the shared token
+        if self._auth_token != self.token:
+            self._auth_token = self.token
+            self.client.headers["Authorization"] = f"Bearer {self._auth_token}"
+
+    async def _fetch_token(self):
+        """Request a new token and store it in the shared cache"""
+        with _timed("token"):
+            resp = await self.client.post(
+                "/tokens",
+                data={"username": self.username, "password": self.password}
+            )
         if resp.status_code in [200, 201]:
-            data = resp.json()
-            self.token = data.get("token")
-            self.token_expires = int(data.get("expired_at") or data.get("expires_at", 0))
+            data = orjson.loads(resp.content)
+            _TOKEN_CACHE[self._token_key] = {
+                "token": data.get("token"),
+                "expires": int(data.get("expired_at") or data.get("expires_at", 0))
+            }
         else:
             raise Exception(f"Authentication failed: {resp.status_code} {resp.text}")
 
-    def request(self, method: str, endpoint: str, params: dict = None, data: dict = None) -> dict:
+    async def _token_refresher(self):
+        """Refresh the token shortly before it expires"""
+        while True:
+            delay = self.token_expires - TOKEN_REFRESH_LEAD - time.time()
+            await asyncio.sleep(max(delay, TOKEN_REFRESH_MIN_INTERVAL))
+            try:
+                async with self._token_lock:
+                    if time.time() >= self.token_expires - TOKEN_REFRESH_LEAD:
+                        await self._fetch_token()
+            except Exception as e:
+                # The inline guard in _ensure_token still covers a failed refresh
+                print(f"Token refresh failed: {e}", file=sys.stderr)
+
+    async def request(self, method: str, endpoint: str, params: dict = None, data: dict = None) -> dict:
         """Make an authenticated API request"""
-        self._ensure_token()
+        await self._ensure_token()
 
-        url = f"{self.base_url}{endpoint}"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Accept": "application/json"
-        }
-
-        if method.upper() == "GET":
-            resp = requests.get(url, headers=headers, params=params)
-        elif method.upper() == "POST":
-            resp = requests.post(url, headers=headers, data=data)
-        else:
-            return {"error": f"Unknown method: {method}"}
+        with _timed(f"upstream {method.upper()}"):
+            if method.upper() == "GET":
+                resp = await self._get_with_retry(endpoint, params)
+            elif method.upper() == "POST":
+                resp = await self.client.post(endpoint, data=data)
+            else:
+                return {"error": f"Unknown method: {method}"}
 
         result = {
             "status_code": resp.status_code,
             "success": resp.status_code in [200, 201, 204]
         }
 
-        if resp.text:
+        # Parse the raw bytes once; only decode to text when the body isn't JSON
+        body = resp.content
+        if body:
             try:
-                result["data"] = resp.json()
-            except:
-                result["data"] = resp.text
+                result["data"] = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                result["data"] = body.decode("utf-8", "replace")
 
         return result
 
+    async def _get_with_retry(self, endpoint: str, params: dict = None) -> httpx.Response:
+        """GET, retrying transport errors and 502/503/504 responses"""
+        for attempt in range(RETRY_ATTEMPTS):
+            last = attempt == RETRY_ATTEMPTS - 1
+            try:
+                resp = await self.client.get(endpoint, params=params)
+            except httpx.TransportError:
+                if last:
+                    raise
+            else:
+                if last or resp.status_code not in RETRY_STATUSES:
+                    return resp
+
+            delay = min(RETRY_MAX_DELAY, RETRY_INITIAL_DELAY * 2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, delay))
+
+    async def warm_up(self):
+        """Open the connection and fetch a token before the first tool call needs them"""
+        try:
+            await self._ensure_token()
+        except Exception as e:
+            # Not fatal: the first tool call will retry and surface the error
+            print(f"nAble warm-up failed: {e}", file=sys.stderr)
+
+    async def aclose(self):
+        """Stop the token refresher and close the underlying connection pool"""
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        await self.client.aclose()
+
 
 # =============================================================================
-# MCP Server Implementation
+# Caching and Request Coalescing
 # =============================================================================
 
-if MCP_AVAILABLE:
-    # Initialize
-    server = Server("nable-api")
-    env = os.environ.get("NABLE_ENV", "production")
-    client = NableClient(env)
+def _args_key(args: dict) -> tuple:
+    """Hashable, order-independent key for a tool's arguments"""
+    return tuple(sorted((k, repr(v)) for k, v in args.items()))
+
+
+def ttl_cache(ttl: float, maxsize: int = 512):
+    """Cache a handler's successful responses for `ttl` seconds, keyed by its arguments"""
+    def decorator(func):
+        cache: dict[tuple, tuple[float, dict]] = {}
+        generation = 0
+
+        @functools.wraps(func)
+        async def wrapper(client: NableClient, args: dict) -> dict:
+            key = (client.env, _args_key(args))
+            now = time.monotonic()
+            hit = cache.get(key)
+            if hit and hit[0] > now:
+                return hit[1]
+
+            started = generation
+            result = await func(client, args)
+            # Skip the insert if invalidate() ran while the call was in flight,
+            # so a pre-invalidation result isn't cached for the full TTL
+            if result.get("success") and generation == started:
+                # Re-insert at the end so eviction order tracks refresh time
+                cache.pop(key, None)
+                if len(cache) >= maxsize:
+                    for k in [k for k, (expires, _) in cache.items() if expires <= now]:
+                        del cache[k]
+                    if len(cache) >= maxsize:
+                        del cache[next(iter(cache))]
+                cache[key] = (now + ttl, result)
+            return result
 
-    @server.list_tools()
-    async def list_tools() -> list[Tool]:
-        """List all available nAble API tools"""
-        return [
-            Tool(
-                name="nable_search_patient",
-                description="Search for a patient by account number (MRN), or by last_name + email + dob",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "account_number": {"type": "string", "description": "Patient MRN/account number"},
-                        "last_name": {"type": "string", "description": "Patient last name"},
-                        "email": {"type": "string", "description": "Patient email"},
-                        "dob": {"type": "string", "description": "Date of birth (YYYY-MM-DD)"}
-                    }
-                }
-            ),
-            Tool(
-                name="nable_get_patient",
-                description="Get patient demographics by patient ID",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer", "description": "Patient ID"}
-                    },
-                    "required": ["patient_id"]
-                }
-            ),
-            Tool(
-                name="nable_create_patient",
-                description="Create a new patient",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "first_name": {"type": "string"},
-                        "last_name": {"type": "string"},
-                        "dob": {"type": "string", "description": "YYYY-MM-DD"},
-                        "email": {"type": "string"},
-                        "phone_cell": {"type": "string"},
-                        "phone_preference": {"type": "string", "enum": ["home", "cell", "work"]}
-                    },
-                    "required": ["first_name", "last_name", "dob", "email", "phone_cell", "phone_preference"]
-                }
-            ),
-            Tool(
-                name="nable_get_appointments",
-                description="Get appointments for a specific date",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "date": {"type": "string", "description": "Date (YYYY-MM-DD)"}
-                    },
-                    "required": ["date"]
-                }
-            ),
-            Tool(
-                name="nable_get_patient_appointments",
-                description="Get appointments for a specific patient",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"},
-                        "include_past": {"type": "boolean", "default": False}
-                    },
-                    "required": ["patient_id"]
-                }
-            ),
-            Tool(
-                name="nable_get_appointment_options",
-                description="Get available facilities, doctors, and appointment types for booking",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"}
-                    },
-                    "required": ["patient_id"]
-                }
-            ),
-            Tool(
-                name="nable_get_available_dates",
-                description="Get available appointment dates for a specific combination",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"},
-                        "facility_id": {"type": "integer"},
-                        "doctor_id": {"type": "integer"},
-                        "appointment_type_id": {"type": "integer"}
-                    },
-                    "required": ["patient_id", "facility_id", "doctor_id", "appointment_type_id"]
-                }
-            ),
-            Tool(
-                name="nable_get_available_times",
-                description="Get available appointment times for a specific date",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"},
-                        "facility_id": {"type": "integer"},
-                        "doctor_id": {"type": "integer"},
-                        "appointment_type_id": {"type": "integer"},
-                        "date": {"type": "string", "description": "YYYY-MM-DD"}
-                    },
-                    "required": ["patient_id", "facility_id", "doctor_id", "appointment_type_id", "date"]
-                }
-            ),
-            Tool(
-                name="nable_book_appointment",
-                description="Book an appointment for a patient",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"},
-                        "facility_id": {"type": "integer"},
-                        "doctor_id": {"type": "integer"},
-                        "appointment_type_id": {"type": "integer"},
-                        "date": {"type": "string"},
-                        "time": {"type": "string"}
-                    },
-                    "required": ["patient_id", "facility_id", "doctor_id", "appointment_type_id", "date", "time"]
-                }
-            ),
-            Tool(
-                name="nable_get_patient_cycles",
-                description="Get treatment cycles for a patient",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"}
-                    },
-                    "required": ["patient_id"]
-                }
-            ),
-            Tool(
-                name="nable_get_cycle_details",
-                description="Get detailed cycle information including embryology, medications, ultrasounds",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"},
-                        "cycle_id": {"type": "string"},
-                        "include": {"type": "string", "description": "Comma-separated: embryology,medications,ultrasounds"}
-                    },
-                    "required": ["patient_id", "cycle_id"]
-                }
-            ),
-            Tool(
-                name="nable_get_patient_messages",
-                description="Get patient inbox/messages",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"}
-                    },
-                    "required": ["patient_id"]
-                }
-            ),
-            Tool(
-                name="nable_send_message",
-                description="Send a message from the patient to the clinic",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"},
-                        "to": {"type": "string", "description": "Recipient"},
-                        "subject": {"type": "string"},
-                        "message": {"type": "string"}
-                    },
-                    "required": ["patient_id", "to", "subject", "message"]
-                }
-            ),
-            Tool(
-                name="nable_get_patient_finances",
-                description="Get patient financial information (balances, quotes, receipts)",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"},
-                        "type": {"type": "string", "enum": ["balances", "quotes", "receipts", "all"]}
-                    },
-                    "required": ["patient_id"]
-                }
-            ),
-            Tool(
-                name="nable_get_medical_records",
-                description="Get patient medical records (prescriptions, vitals, insurance)",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "patient_id": {"type": "integer"},
-                        "type": {"type": "string", "enum": ["prescriptions", "vitals", "insurance", "all"]}
-                    },
-                    "required": ["patient_id"]
-                }
-            ),
-            Tool(
-                name="nable_get_options",
-                description="Get dropdown options for a field (e.g., language_preference, phone_preference)",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "keys": {"type": "string", "description": "Comma-separated option keys"}
-                    },
-                    "required": ["keys"]
-                }
-            )
-        ]
+        def invalidate():
+            """Drop every cached entry, including results still in flight"""
+            nonlocal generation
+            generation += 1
+            cache.clear()
+            # Later callers must not join a single-flight call started before now
+            for k in [k for k in _INFLIGHT if k[0] == func.__name__]:
+                del _INFLIGHT[k]
+
+        wrapper.cache = cache
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
+
+
+# Tasks for GET-style tool calls currently awaiting the upstream API
+_INFLIGHT: dict[tuple, asyncio.Task] = {}
+
+
+def _single_flight_done(key: tuple, task: asyncio.Task):
+    # Only drop our own entry; invalidate() may have replaced it since
+    if _INFLIGHT.get(key) is task:
+        del _INFLIGHT[key]
+    # Mark the error retrieved in case every caller was cancelled before reading it
+    if not task.cancelled():
+        task.exception()
+
+
+def single_flight(func):
+    """Share one in-flight call between concurrent callers with identical arguments"""
+    @functools.wraps(func)
+    async def wrapper(client: NableClient, args: dict) -> dict:
+        key = (func.__name__, client.env, _args_key(args))
+        task = _INFLIGHT.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(client, args))
+            _INFLIGHT[key] = task
+            task.add_done_callback(functools.partial(_single_flight_done, key))
+        # Shield so one caller being cancelled doesn't cancel the shared call
+        return await asyncio.shield(task)
+
+    return wrapper
+
+
+class OptionsBatcher:
+    """Coalesce /options lookups made within a short window into one request
+
+    Slicing a merged response assumes /options answers `key=a,b` with `data`
+    as a dict keyed by option name. Nothing upstream documents that shape, so
+    the first successful response that doesn't match turns batching off and
+    later lookups go straight to the API.
+    """
+
+    def __init__(self, window: float = 0.01):
+        self.window = window
+        self.enabled = True
+        self._pending: list[tuple[list[str], asyncio.Future]] = []
+        self._flush_task = None
+
+    async def get(self, client: NableClient, keys: list[str]) -> dict:
+        if not self.enabled:
+            return await client.request("GET", "/options", params={"key": ",".join(keys)})
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((keys, fut))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush(client))
+        return await fut
+
+    async def _flush(self, client: NableClient):
+        await asyncio.sleep(self.window)
+        pending, self._pending = self._pending, []
+        self._flush_task = None
+
+        # A lone caller's request is exactly the merged one, so it gets the outcome as is
+        if len(pending) == 1:
+            await self._fetch_alone(client, *pending[0])
+            return
 
-    @server.call_tool()
-    async def call_tool(name: str, arguments: dict) -> list[TextContent]:
-        """Handle tool calls"""
+        all_keys = sorted({k for keys, _ in pending for k in keys})
         try:
-            result = await handle_tool(name, arguments)
-            return [TextContent(type="text", text=json.dumps(result, indent=2, default=str))]
+            resp = await client.request("GET", "/options", params={"key": ",".join(all_keys)})
         except Exception as e:
-            return [TextContent(type="text", text=json.dumps({"error": str(e)}))]
-
-    async def handle_tool(name: str, args: dict) -> dict:
-        """Route tool calls to appropriate handlers"""
+            # Already retried inside request(); retrying per caller would only multiply it
+            for _, fut in pending:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
 
-        if name == "nable_search_patient":
-            params = {}
-            if args.get("account_number"):
-                params["account_number"] = args["account_number"]
+        if not resp.get("success"):
+            # Server-side or rate-limit failures hit every caller alike; only a
+            # 4xx may come from one caller's bad key and is worth splitting up
+            status = resp.get("status_code", 0)
+            if 400 <= status < 500 and status != 429:
+                retry = pending
             else:
-                params = {k: v for k, v in args.items() if v}
-            return client.request("GET", "/patients/search", params=params)
+                retry = []
+                for _, fut in pending:
+                    if not fut.done():
+                        fut.set_result(resp)
+        elif not isinstance(resp.get("data"), dict) or not any(k in resp["data"] for k in all_keys):
+            # A body that answers none of the keys (a list, or a wrapper such as
+            # {"options": [...]}) isn't keyed by option, so slicing can never work
+            self.enabled = False
+            print("nAble /options response isn't keyed by option; batching disabled", file=sys.stderr)
+            retry = pending
+        else:
+            # Callers whose keys the merged response lacks are re-fetched individually
+            retry = []
+            for keys, fut in pending:
+                if fut.done():
+                    continue
+                sliced = self._slice(resp, keys)
+                if sliced is None:
+                    retry.append((keys, fut))
+                else:
+                    fut.set_result(sliced)
+
+        await asyncio.gather(*(self._fetch_alone(client, keys, fut) for keys, fut in retry))
+
+    @staticmethod
+    async def _fetch_alone(client: NableClient, keys: list[str], fut: asyncio.Future):
+        """Resolve one caller's future with its own /options request"""
+        if fut.done():
+            return
+        try:
+            result = await client.request("GET", "/options", params={"key": ",".join(keys)})
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        if not fut.done():
+            fut.set_result(result)
 
-        elif name == "nable_get_patient":
-            return client.request("GET", f"/patients/{args['patient_id']}")
+    @staticmethod
+    def _slice(resp: dict, keys: list[str]) -> dict | None:
+        """Narrow a batched response to the keys one caller asked for, or None if it can't"""
+        data = resp["data"]
+        if all(k in data for k in keys):
+            return {**resp, "data": {k: data[k] for k in keys}}
+        return None
 
-        elif name == "nable_create_patient":
-            return client.request("POST", "/patients", data=args)
 
-        elif name == "nable_get_appointments":
-            return client.request("GET", "/appointments", params={"date": args["date"]})
+# One batcher per environment, created on first use
+_OPTIONS_BATCHERS: dict[str, OptionsBatcher] = {}
 
-        elif name == "nable_get_patient_appointments":
-            params = {"past": "true"} if args.get("include_past") else {}
-            return client.request("GET", f"/patients/{args['patient_id']}/appointments", params=params)
 
-        elif name == "nable_get_appointment_options":
-            return client.request("GET", f"/patients/{args['patient_id']}/appointments/options")
+# =============================================================================
+# Tool Handlers
+# =============================================================================
 
-        elif name == "nable_get_available_dates":
-            params = {
-                "patient_id": args["patient_id"],
-                "facility_id": args["facility_id"],
-                "doctor_id": args["doctor_id"],
-                "appointment_type_id": args["appointment_type_id"]
-            }
-            return client.request("GET", "/resources/schedules/dates", params=params)
-
-        elif name == "nable_get_available_times":
-            params = {
-                "patient_id": args["patient_id"],
-                "facility_id": args["facility_id"],
-                "doctor_id": args["doctor_id"],
-                "appointment_type_id": args["appointment_type_id"]
-            }
-            return client.request("GET", f"/resources/schedules/dates/{args['date']}/times", params=params)
+# Passthrough tools: (method, path_template, query_keys, body_keys).
+# body_keys of None sends every argument not consumed by the path template.
+SPECS = {
+    "nable_get_patient": ("GET", "/patients/{patient_id}", (), ()),
+    "nable_create_patient": ("POST", "/patients", (), None),
+    "nable_get_appointments": ("GET", "/appointments", ("date",), ()),
+    "nable_get_appointment_options": ("GET", "/patients/{patient_id}/appointments/options", (), ()),
+    "nable_get_available_dates": (
+        "GET", "/resources/schedules/dates",
+        ("patient_id", "facility_id", "doctor_id", "appointment_type_id"), ()
+    ),
+    "nable_get_available_times": (
+        "GET", "/resources/schedules/dates/{date}/times",
+        ("patient_id", "facility_id", "doctor_id", "appointment_type_id"), ()
+    ),
+    "nable_book_appointment": ("POST", "/patients/{patient_id}/appointments", (), None),
+    "nable_get_patient_cycles": ("GET", "/patients/{patient_id}/cycles", (), ()),
+    "nable_get_patient_messages": ("GET", "/patients/{patient_id}/messages", (), ()),
+    "nable_send_message": ("POST", "/patients/{patient_id}/messages", (), None),
+}
 
-        elif name == "nable_book_appointment":
-            pid = args.pop("patient_id")
-            return client.request("POST", f"/patients/{pid}/appointments", data=args)
+# Cache lifetimes (seconds) for slowly changing passthrough GETs
+SPEC_TTLS = {
+    "nable_get_appointment_options": 15 * 60,
+    "nable_get_available_dates": 60,
+}
 
-        elif name == "nable_get_patient_cycles":
-            return client.request("GET", f"/patients/{args['patient_id']}/cycles")
+# Cached tools whose results a successful POST makes stale
+SPEC_INVALIDATES = {
+    "nable_book_appointment": ("nable_get_available_dates",),
+}
 
-        elif name == "nable_get_cycle_details":
-            pid = args["patient_id"]
-            cid = args["cycle_id"]
-            include = args.get("include", "").split(",")
 
-            result = {"cycle": client.request("GET", f"/patients/{pid}/cycles/{cid}")}
+def _spec_tool(name: str, spec: tuple):
+    """Build a handler for a passthrough tool from its spec"""
+    method, path, query_keys, body_keys = spec
+    path_keys = {key for _, key, _, _ in string.Formatter().parse(path) if key}
 
-            if "embryology" in include or not include[0]:
-                result["embryology"] = client.request("GET", f"/patients/{pid}/cycles/{cid}/embryology")
-            if "medications" in include:
-                result["medications"] = client.request("GET", f"/patients/{pid}/cycles/{cid}/medications")
-            if "ultrasounds" in include:
-                result["ultrasounds"] = client.request("GET", f"/patients/{pid}/cycles/{cid}/ultrasounds")
+    async def handler(client: NableClient, args: dict) -> dict:
+        endpoint = path.format(**args)
+        params = {k: args[k] for k in query_keys if k in args}
+        if body_keys is None:
+            data = {k: v for k, v in args.items() if k not in path_keys}
+        else:
+            data = {k: args[k] for k in body_keys if k in args}
+        result = await client.request(method, endpoint, params=params or None, data=data or None)
+        if result.get("success"):
+            for stale in SPEC_INVALIDATES.get(name, ()):
+                TOOLS[stale].invalidate()
+        return result
 
-            return result
+    handler.__name__ = handler.__qualname__ = name
 
-        elif name == "nable_get_patient_messages":
-            return client.request("GET", f"/patients/{args['patient_id']}/messages")
+    # Only reads are coalesced or cached; POSTs always reach the API
+    if method == "GET":
+        handler = single_flight(handler)
+        if name in SPEC_TTLS:
+            handler = ttl_cache(ttl=SPEC_TTLS[name])(handler)
+    return handler
 
-        elif name == "nable_send_message":
-            pid = args.pop("patient_id")
-            return client.request("POST", f"/patients/{pid}/messages", data=args)
 
-        elif name == "nable_get_patient_finances":
-            pid = args["patient_id"]
-            ftype = args.get("type", "all")
+@single_flight
+async def _search_patient(client: NableClient, args: dict) -> dict:
+    params = {}
+    if args.get("account_number"):
+        params["account_number"] = args["account_number"]
+    else:
+        params = {k: v for k, v in args.items() if v}
+    return await client.request("GET", "/patients/search", params=params)
 
-            if ftype == "all":
-                return {
-                    "balances": client.request("GET", f"/patients/{pid}/balances"),
-                    "quotes": client.request("GET", f"/patients/{pid}/quotes"),
-                    "receipts": client.request("GET", f"/patients/{pid}/receipts")
-                }
-            else:
-                return client.request("GET", f"/patients/{pid}/{ftype}")
 
-        elif name == "nable_get_medical_records":
-            pid = args["patient_id"]
-            rtype = args.get("type", "all")
+@single_flight
+async def _get_patient_appointments(client: NableClient, args: dict) -> dict:
+    params = {"past": "true"} if args.get("include_past") else {}
+    return await client.request("GET", f"/patients/{args['patient_id']}/appointments", params=params)
+
+
+# Optional sub-resources of a cycle; all are fetched when `include` is empty
+CYCLE_SECTIONS = ("embryology", "medications", "ultrasounds")
+
+
+@single_flight
+async def _get_cycle_details(client: NableClient, args: dict) -> dict:
+    pid = args["patient_id"]
+    cid = args["cycle_id"]
+    includes = {s.strip() for s in (args.get("include") or "").split(",") if s.strip()}
+    fetch_all = not includes
+
+    keys = ["cycle"]
+    tasks = [client.request("GET", f"/patients/{pid}/cycles/{cid}")]
+
+    for section in CYCLE_SECTIONS:
+        if fetch_all or section in includes:
+            keys.append(section)
+            tasks.append(client.request("GET", f"/patients/{pid}/cycles/{cid}/{section}"))
+
+    return dict(zip(keys, await asyncio.gather(*tasks)))
+
+
+@single_flight
+async def _get_patient_finances(client: NableClient, args: dict) -> dict:
+    pid = args["patient_id"]
+    ftype = args.get("type", "all")
+
+    if ftype == "all":
+        balances, quotes, receipts = await asyncio.gather(
+            client.request("GET", f"/patients/{pid}/balances"),
+            client.request("GET", f"/patients/{pid}/quotes"),
+            client.request("GET", f"/patients/{pid}/receipts")
+        )
+        return {"balances": balances, "quotes": quotes, "receipts": receipts}
+    else:
+        return await client.request("GET", f"/patients/{pid}/{ftype}")
+
+
+@single_flight
+async def _get_medical_records(client: NableClient, args: dict) -> dict:
+    pid = args["patient_id"]
+    rtype = args.get("type", "all")
+
+    if rtype == "all":
+        prescriptions, vitals, insurance = await asyncio.gather(
+            client.request("GET", f"/patients/{pid}/medical-records/prescriptions"),
+            client.request("GET", f"/patients/{pid}/medical-records/vitals"),
+            client.request("GET", f"/patients/{pid}/insurance")
+        )
+        return {"prescriptions": prescriptions, "vitals": vitals, "insurance": insurance}
+    elif rtype == "insurance":
+        return await client.request("GET", f"/patients/{pid}/insurance")
+    else:
+        return await client.request("GET", f"/patients/{pid}/medical-records/{rtype}")
+
+
+@ttl_cache(ttl=6 * 60 * 60)
+async def _get_options(client: NableClient, args: dict) -> dict:
+    keys = [k.strip() for k in args["keys"].split(",") if k.strip()]
+    if not keys:
+        return await client.request("GET", "/options", params={"key": args["keys"]})
+    batcher = _OPTIONS_BATCHERS.setdefault(client.env, OptionsBatcher())
+    return await batcher.get(client, keys)
+
+
+async def _perf_stats(client: NableClient, args: dict) -> dict:
+    return perf_stats()
+
+
+TOOLS = {
+    **{name: _spec_tool(name, spec) for name, spec in SPECS.items()},
+    "nable_search_patient": _search_patient,
+    "nable_get_patient_appointments": _get_patient_appointments,
+    "nable_get_cycle_details": _get_cycle_details,
+    "nable_get_patient_finances": _get_patient_finances,
+    "nable_get_medical_records": _get_medical_records,
+    "nable_get_options": _get_options,
+    "nable_perf_stats": _perf_stats,
+}
+
+
+# =============================================================================
+# MCP Server Implementation
+# =============================================================================
 
-            if rtype == "all":
-                return {
-                    "prescriptions": client.request("GET", f"/patients/{pid}/medical-records/prescriptions"),
-                    "vitals": client.request("GET", f"/patients/{pid}/medical-records/vitals"),
-                    "insurance": client.request("GET", f"/patients/{pid}/insurance")
+if MCP_AVAILABLE:
+    # Initialize
+    server = Server("nable-api")
+    env = os.environ.get("NABLE_ENV", "production")
+    client = NableClient(env)
+
+    # Tool definitions never change at runtime, so build them once at import
+    _TOOL_LIST = [
+        Tool(
+            name="nable_search_patient",
+            description="Search for a patient by account number (MRN), or by last_name + email + dob",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "account_number": {"type": "string", "description": "Patient MRN/account number"},
+                    "last_name": {"type": "string", "description": "Patient last name"},
+                    "email": {"type": "string", "description": "Patient email"},
+                    "dob": {"type": "string", "description": "Date of birth (YYYY-MM-DD)"}
                 }
-            elif rtype == "insurance":
-                return client.request("GET", f"/patients/{pid}/insurance")
-            else:
-                return client.request("GET", f"/patients/{pid}/medical-records/{rtype}")
+            }
+        ),
+        Tool(
+            name="nable_get_patient",
+            description="Get patient demographics by patient ID",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer", "description": "Patient ID"}
+                },
+                "required": ["patient_id"]
+            }
+        ),
+        Tool(
+            name="nable_create_patient",
+            description="Create a new patient",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "first_name": {"type": "string"},
+                    "last_name": {"type": "string"},
+                    "dob": {"type": "string", "description": "YYYY-MM-DD"},
+                    "email": {"type": "string"},
+                    "phone_cell": {"type": "string"},
+                    "phone_preference": {"type": "string", "enum": ["home", "cell", "work"]}
+                },
+                "required": ["first_name", "last_name", "dob", "email", "phone_cell", "phone_preference"]
+            }
+        ),
+        Tool(
+            name="nable_get_appointments",
+            description="Get appointments for a specific date",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "date": {"type": "string", "description": "Date (YYYY-MM-DD)"}
+                },
+                "required": ["date"]
+            }
+        ),
+        Tool(
+            name="nable_get_patient_appointments",
+            description="Get appointments for a specific patient",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"},
+                    "include_past": {"type": "boolean", "default": False}
+                },
+                "required": ["patient_id"]
+            }
+        ),
+        Tool(
+            name="nable_get_appointment_options",
+            description="Get available facilities, doctors, and appointment types for booking",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"}
+                },
+                "required": ["patient_id"]
+            }
+        ),
+        Tool(
+            name="nable_get_available_dates",
+            description="Get available appointment dates for a specific combination",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"},
+                    "facility_id": {"type": "integer"},
+                    "doctor_id": {"type": "integer"},
+                    "appointment_type_id": {"type": "integer"}
+                },
+                "required": ["patient_id", "facility_id", "doctor_id", "appointment_type_id"]
+            }
+        ),
+        Tool(
+            name="nable_get_available_times",
+            description="Get available appointment times for a specific date",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"},
+                    "facility_id": {"type": "integer"},
+                    "doctor_id": {"type": "integer"},
+                    "appointment_type_id": {"type": "integer"},
+                    "date": {"type": "string", "description": "YYYY-MM-DD"}
+                },
+                "required": ["patient_id", "facility_id", "doctor_id", "appointment_type_id", "date"]
+            }
+        ),
+        Tool(
+            name="nable_book_appointment",
+            description="Book an appointment for a patient",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"},
+                    "facility_id": {"type": "integer"},
+                    "doctor_id": {"type": "integer"},
+                    "appointment_type_id": {"type": "integer"},
+                    "date": {"type": "string"},
+                    "time": {"type": "string"}
+                },
+                "required": ["patient_id", "facility_id", "doctor_id", "appointment_type_id", "date", "time"]
+            }
+        ),
+        Tool(
+            name="nable_get_patient_cycles",
+            description="Get treatment cycles for a patient",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"}
+                },
+                "required": ["patient_id"]
+            }
+        ),
+        Tool(
+            name="nable_get_cycle_details",
+            description="Get detailed cycle information including embryology, medications, ultrasounds",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"},
+                    "cycle_id": {"type": "string"},
+                    "include": {"type": "string", "description": "Comma-separated: embryology,medications,ultrasounds (default: all)"}
+                },
+                "required": ["patient_id", "cycle_id"]
+            }
+        ),
+        Tool(
+            name="nable_get_patient_messages",
+            description="Get patient inbox/messages",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"}
+                },
+                "required": ["patient_id"]
+            }
+        ),
+        Tool(
+            name="nable_send_message",
+            description="Send a message from the patient to the clinic",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"},
+                    "to": {"type": "string", "description": "Recipient"},
+                    "subject": {"type": "string"},
+                    "message": {"type": "string"}
+                },
+                "required": ["patient_id", "to", "subject", "message"]
+            }
+        ),
+        Tool(
+            name="nable_get_patient_finances",
+            description="Get patient financial information (balances, quotes, receipts)",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"},
+                    "type": {"type": "string", "enum": ["balances", "quotes", "receipts", "all"]}
+                },
+                "required": ["patient_id"]
+            }
+        ),
+        Tool(
+            name="nable_get_medical_records",
+            description="Get patient medical records (prescriptions, vitals, insurance)",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "patient_id": {"type": "integer"},
+                    "type": {"type": "string", "enum": ["prescriptions", "vitals", "insurance", "all"]}
+                },
+                "required": ["patient_id"]
+            }
+        ),
+        Tool(
+            name="nable_get_options",
+            description="Get dropdown options for a field (e.g., language_preference, phone_preference)",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "keys": {"type": "string", "description": "Comma-separated option keys"}
+                },
+                "required": ["keys"]
+            }
+        ),
+        Tool(
+            name="nable_perf_stats",
+            description="Get server latency stats (p50/p95/p99 ms) per tool, upstream API call, token refresh and serialization",
+            inputSchema={
+                "type": "object",
+                "properties": {}
+            }
+        )
+    ]
 
-        elif name == "nable_get_options":
-            return client.request("GET", "/options", params={"key": args["keys"]})
+    @server.list_tools()
+    async def list_tools() -> list[Tool]:
+        """List all available nAble API tools"""
+        return _TOOL_LIST
 
-        else:
+    @server.call_tool()
+    async def call_tool(name: str, arguments: dict) -> list[TextContent]:
+        """Handle tool calls"""
+        try:
+            result = await handle_tool(name, arguments)
+            with _timed("serialize"):
+                text = orjson.dumps(result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str)
+            return [TextContent(type="text", text=text.decode())]
+        except Exception as e:
+            return [TextContent(type="text", text=orjson.dumps({"error": str(e)}).decode())]
+
+    async def handle_tool(name: str, args: dict) -> dict:
+        """Route tool calls to appropriate handlers"""
+        try:
+            handler = TOOLS[name]
+        except KeyError:
             return {"error": f"Unknown tool: {name}"}
+        with _timed(name):
+            return await handler(client, args)
 
     async def main():
         """Run the MCP server"""
-        async with stdio_server() as (read_stream, write_stream):
-            await server.run(read_stream, write_stream, server.create_initialization_options())
+        # Warm up in the background so MCP initialization isn't delayed
+        warm_up = asyncio.create_task(client.warm_up())
+        try:
+            async with stdio_server() as (read_stream, write_stream):
+                await server.run(read_stream, write_stream, server.create_initialization_options())
+        finally:
+            warm_up.cancel()
+            await client.aclose()
 
     if __name__ == "__main__":
-        import asyncio
+        # uvloop lowers event-loop overhead for the HTTPS fan-outs; optional and POSIX-only
+        if sys.platform != "win32":
+            try:
+                import uvloop
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            except ImportError:
+                pass
         asyncio.run(main())